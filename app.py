@@ -1,34 +1,69 @@
 import os
+import base64
 import secrets
 import hmac
 import hashlib
+import threading
+import time
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
-from sqlalchemy import create_engine, text
+import orjson
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import DateTime, column, create_engine, insert, table, text
+from cachetools import TLRUCache, TTLCache
 
 # --- FIXED IMPORTS ---
 # 1. Standard requests library for HTTP calls (like getting userinfo)
 import requests as http_requests
-# 2. Google Auth specific requests for the Request class (for ID tokens)
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_auth_requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+# 2. Google Auth RSA verifiers (for ID tokens, built once per signing cert)
+from google.auth import crypt as google_crypt
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON in and out via orjson; responses are built straight from its bytes."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default), mimetype=self.mimetype
+        )
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # --- CONFIGURATION ---
 DEFAULT_GDRIVE_ID = os.environ.get("GDRIVE_ID", "PASTE_YOUR_GDRIVE_ID_HERE")
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID", None)
 SESSION_SECRET = os.environ.get("SESSION_SECRET", "change-this-secret-now")
 DB_URL = os.environ.get("DATABASE_URL")
+# Per-process pool: Postgres sees up to processes x (pool + overflow) connections.
+# Under gunicorn, gunicorn.conf.py splits DB_MAX_CONNECTIONS across the workers.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+
+# Keyed HMAC state is derived once; each signature works on a copy.
+_SECRET_BYTES = SESSION_SECRET.encode()
+_HMAC_TEMPLATE = hmac.new(_SECRET_BYTES, b'', hashlib.sha256)
 
 # --- DATABASE CONNECTION ---
 if DB_URL:
     if DB_URL.startswith("postgres://"):
         DB_URL = DB_URL.replace("postgres://", "postgresql://", 1)
-    engine = create_engine(DB_URL)
+    # LIFO checkout keeps reusing the most recently warmed connections.
+    engine = create_engine(
+        DB_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=10,
+        pool_recycle=1800, pool_pre_ping=True, pool_use_lifo=True
+    )
 else:
     print("⚠️ WARNING: DATABASE_URL not set. Using local SQLite.")
-    engine = create_engine("sqlite:///temp.db")
+    engine = create_engine("sqlite:///temp.db", connect_args={"check_same_thread": False})
 
 # --- DATABASE INITIALIZATION ---
 def init_db():
@@ -56,43 +91,213 @@ def init_db():
                 expires_at TIMESTAMP
             );
         """))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_sessions_expires ON active_sessions (expires_at);"
+        ))
+        # Covering index so the per-user session lookup is an index-only scan.
+        if engine.dialect.name == "postgresql":
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_sessions_email_expiry "
+                "ON active_sessions (user_email) INCLUDE (expires_at);"
+            ))
+        else:
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_sessions_email_expiry "
+                "ON active_sessions (user_email, expires_at);"
+            ))
         conn.commit()
 
 with app.app_context():
     init_db()
 
+# --- SQL STATEMENTS ---
+# Built once at import so request handlers don't reconstruct text() objects.
+# Typing expires_at as DateTime makes SQLite's stored strings come back as
+# datetimes too, so callers never parse them.
+_Q_SESSION_AND_FILE = text(
+    "SELECT (SELECT expires_at FROM active_sessions WHERE user_email = :e) AS expires_at, "
+    "(SELECT gdrive_id FROM file_registry WHERE name = :n) AS gdrive_id"
+).columns(expires_at=DateTime)
+_Q_SESSION_AND_DEFAULT_FILE = text(
+    "SELECT (SELECT expires_at FROM active_sessions WHERE user_email = :e) AS expires_at, "
+    "(SELECT gdrive_id FROM file_registry LIMIT 1) AS gdrive_id"
+).columns(expires_at=DateTime)
+_Q_CONSUME_LICENSE = text(
+    "UPDATE licenses SET status = 'used' WHERE key_code = :k AND status = 'unused' "
+    "RETURNING duration_hours"
+)
+_Q_LICENSE_EXISTS = text("SELECT 1 FROM licenses WHERE key_code = :k")
+_Q_UPSERT_SESSION = text(
+    "INSERT INTO active_sessions (user_email, expires_at) VALUES (:e, :t) "
+    "ON CONFLICT (user_email) DO UPDATE SET expires_at = excluded.expires_at"
+)
+_Q_SWEEP_SESSIONS = text("DELETE FROM active_sessions WHERE expires_at < :t")
+_Q_LIST_FILES = text("SELECT name, gdrive_id FROM file_registry ORDER BY id DESC")
+_Q_LIST_FILES_PAGE = text(
+    "SELECT name, gdrive_id FROM file_registry ORDER BY id DESC LIMIT :lim OFFSET :off"
+)
+_Q_ADD_FILE = text("INSERT INTO file_registry (name, gdrive_id) VALUES (:n, :g)")
+# A Core insert() (not text()) so a batch is sent as multi-row VALUES on Postgres.
+_Q_ADD_LICENSES = insert(table("licenses", column("key_code"), column("duration_hours")))
+
+# --- SESSION CACHE ---
+# (email, requested_file) -> (expires_at, gdrive_id) for sessions that were valid
+# when read. Entries live at most 60s and are never used past expires_at.
+_session_cache = TTLCache(maxsize=10000, ttl=60)
+_session_cache_lock = threading.Lock()
+
+# --- SESSION SWEEPER ---
+# Expired sessions are removed in bulk here instead of on the request path.
+SWEEP_INTERVAL = 300
+
+def sweep_expired_sessions():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            with engine.connect() as conn:
+                conn.execute(_Q_SWEEP_SESSIONS, {"t": datetime.now()})
+                conn.commit()
+        except Exception as e:
+            print(f"⚠️ WARNING: session sweep failed: {e}")
+
+threading.Thread(target=sweep_expired_sessions, daemon=True).start()
+
+# --- GOOGLE VERIFICATION CACHE ---
+# One pooled HTTP session keeps TCP/TLS to googleapis.com alive between calls.
+_google_session = http_requests.Session()
+_google_session.mount("https://", HTTPAdapter(
+    pool_connections=50, pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+))
+_google_session.headers["Accept"] = "application/json"
+# (token_type, sha256(token)) -> (email, ttl), so repeat polls skip the network
+# call / signature check. Each entry carries its own ttl (see verify_google_token).
+_token_cache = TLRUCache(maxsize=10000, ttu=lambda _key, value, now: now + value[1])
+_token_cache_lock = threading.Lock()
+
+# Google's ID-token signing keys as parsed verifiers (kid -> RSAVerifier),
+# refetched at most hourly so no request parses a PEM.
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+_certs_cache = TTLCache(maxsize=1, ttl=3600)
+_certs_cache_lock = threading.Lock()
+
 # --- HELPER FUNCTIONS ---
 
-def generate_session_token(email, hours):
-    expiry = datetime.now() + timedelta(hours=hours)
-    expiry_str = expiry.isoformat()
-    message = f"{email}:{expiry_str}"
-    signature = hmac.new(
-        SESSION_SECRET.encode(), message.encode(), hashlib.sha256
-    ).hexdigest()[:16]
+def generate_session_token(email, expires_at):
+    expiry_str = expires_at.isoformat()
+    h = _HMAC_TEMPLATE.copy()
+    h.update(f"{email}:{expiry_str}".encode())
+    signature = h.digest()[:8].hex()
     return f"{email}:{expiry_str}:{signature}"
 
+def session_granted(email, expires_at, gdrive_id, now):
+    remaining = (expires_at - now).total_seconds() / 3600
+    return jsonify({
+        "authorized": True, "email": email, "hours_remaining": round(remaining, 2),
+        "gdrive_id": gdrive_id or DEFAULT_GDRIVE_ID,
+        "session_token": generate_session_token(email, expires_at)
+    })
+
+def check_session(conn, email, requested_file):
+    """Returns (expires_at, gdrive_id) for the user and file in one round-trip."""
+    lookup = _Q_SESSION_AND_FILE if requested_file else _Q_SESSION_AND_DEFAULT_FILE
+    expires_at, file_id = conn.execute(lookup, {"e": email, "n": requested_file}).fetchone()
+    return expires_at, file_id
+
+def activate_license(conn, email, key, now):
+    """Consumes a license key and starts a session. Returns (expires_at, hours, error)."""
+    # Check-and-consume in one statement, so two racing requests can't both use a key.
+    row = conn.execute(_Q_CONSUME_LICENSE, {"k": key}).fetchone()
+
+    if not row:
+        exists = conn.execute(_Q_LICENSE_EXISTS, {"k": key}).fetchone()
+        return None, None, "Key already used" if exists else "Invalid license key"
+
+    duration = row[0]
+    new_expiry = now + timedelta(hours=duration)
+    conn.execute(_Q_UPSERT_SESSION, {"e": email, "t": new_expiry})
+    return new_expiry, duration, None
+
+def fetch_google_verifiers():
+    """Returns {kid: verifier} for Google's ID-token certs, from cache when fresh."""
+    with _certs_cache_lock:
+        verifiers = _certs_cache.get(GOOGLE_CERTS_URL)
+        if verifiers is None:
+            response = _google_session.get(GOOGLE_CERTS_URL, timeout=10)
+            response.raise_for_status()
+            verifiers = _certs_cache[GOOGLE_CERTS_URL] = {
+                kid: google_crypt.RSAVerifier.from_string(cert)
+                for kid, cert in response.json().items()
+            }
+    return verifiers
+
+def b64url_decode(segment):
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+def verify_google_id_token(token):
+    """Checks an ID token's RS256 signature, exp/iat, aud and iss; returns its claims."""
+    if token.count('.') != 2: raise ValueError("Malformed token")
+    header_b64, payload_b64, signature_b64 = token.split('.')
+    header = orjson.loads(b64url_decode(header_b64))
+    verifier = fetch_google_verifiers().get(header.get('kid'))
+    if header.get('alg') != 'RS256' or verifier is None:
+        raise ValueError("Unknown signing key")
+    if not verifier.verify(f"{header_b64}.{payload_b64}".encode(), b64url_decode(signature_b64)):
+        raise ValueError("Could not verify token signature.")
+
+    idinfo = orjson.loads(b64url_decode(payload_b64))
+    for claim in ('iat', 'exp'):
+        if claim not in idinfo: raise ValueError(f"Token does not contain required claim {claim}")
+    now = time.time()
+    if idinfo['exp'] < now: raise ValueError("Token expired")
+    if idinfo['iat'] > now: raise ValueError("Token used too early")
+    if GOOGLE_CLIENT_ID and idinfo.get('aud') != GOOGLE_CLIENT_ID: raise ValueError("Wrong audience")
+    if idinfo.get('iss') not in GOOGLE_ISSUERS: raise ValueError("Wrong issuer")
+    return idinfo
+
+def warm_google_certs():
+    try:
+        fetch_google_verifiers()
+    except Exception as e:
+        print(f"⚠️ WARNING: could not prefetch Google certs: {e}")
+
 def verify_google_token(token, token_type="access_token"):
     """Verifies Google token and returns user email."""
+    cache_key = (token_type == "id_token", hashlib.sha256(token.encode()).digest())
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    if cached: return cached[0], None
+
     if token_type == "id_token":
         try:
-            idinfo = id_token.verify_oauth2_token(
-                token, google_auth_requests.Request(), GOOGLE_CLIENT_ID
-            )
+            idinfo = verify_google_id_token(token)
             if not idinfo.get('email_verified', False): return None, "Email not verified"
-            return idinfo.get('email'), None
+            email = idinfo.get('email')
+            # Never serve a cached ID token past its own exp.
+            ttl = min(300, idinfo['exp'] - time.time())
         except Exception as e: return None, str(e)
     else:
         # FIX: Use the standard 'http_requests' library, not google_auth_requests
         try:
-            response = http_requests.get(
+            response = _google_session.get(
                 "https://www.googleapis.com/oauth2/v2/userinfo",
                 headers={"Authorization": f"Bearer {token}"}, timeout=10
             )
             if response.status_code != 200: return None, "Invalid token"
-            return response.json().get('email'), None
+            email = response.json().get('email')
+            # Access tokens are opaque; keep revocations visible within a minute.
+            ttl = 60
         except Exception as e: return None, str(e)
 
+    if email and ttl > 0:
+        with _token_cache_lock:
+            _token_cache[cache_key] = (email, ttl)
+    return email, None
+
+if GOOGLE_CLIENT_ID:
+    threading.Thread(target=warm_google_certs, daemon=True).start()
+
 # --- ROUTES ---
 
 @app.route('/')
@@ -107,7 +312,7 @@ def authorize():
     provided_key = data.get('key')
     requested_file = data.get('requested_file')
 
-    if not google_token:
+    if not google_token or not isinstance(google_token, str):
         return jsonify({"authorized": False, "error": "Google token required"}), 400
 
     # 1. Verify Identity
@@ -115,80 +320,55 @@ def authorize():
     if error:
         return jsonify({"authorized": False, "error": f"Google auth failed: {error}"}), 403
 
-    gdrive_id_to_return = None
-
-    with engine.connect() as conn:
-        # 2. Check Session
-        session = conn.execute(
-            text("SELECT expires_at FROM active_sessions WHERE user_email = :e"), {"e": email}
-        ).fetchone()
-
-        if session:
-            expires_at = session[0]
-            if isinstance(expires_at, str): expires_at = datetime.fromisoformat(expires_at)
-            
-            if datetime.now() < expires_at:
-                remaining = (expires_at - datetime.now()).total_seconds() / 3600
-                
-                # 3. GET THE REQUESTED FILE ID
-                if requested_file:
-                    file_row = conn.execute(
-                        text("SELECT gdrive_id FROM file_registry WHERE name = :n"), 
-                        {"n": requested_file}
-                    ).fetchone()
-                    if file_row:
-                        gdrive_id_to_return = file_row[0]
-                    else:
-                        return jsonify({"authorized": False, "error": f"File '{requested_file}' not found on server."}), 404
-                else:
-                    row = conn.execute(text("SELECT gdrive_id FROM file_registry LIMIT 1")).fetchone()
-                    gdrive_id_to_return = row[0] if row else DEFAULT_GDRIVE_ID
-
-                return jsonify({
-                    "authorized": True, "email": email, "hours_remaining": round(remaining, 2),
-                    "gdrive_id": gdrive_id_to_return,
-                    "session_token": generate_session_token(email, remaining)
-                })
-            else:
-                conn.execute(text("DELETE FROM active_sessions WHERE user_email = :e"), {"e": email})
-                conn.commit()
-
-        # 4. Check License Key
-        if not provided_key:
-            return jsonify({"authorized": False, "needs_key": True, "error": "Active license required."}), 401
-
-        row = conn.execute(
-            text("SELECT status, duration_hours FROM licenses WHERE key_code = :k"), {"k": provided_key}
-        ).fetchone()
-
-        if not row: return jsonify({"authorized": False, "error": "Invalid license key"}), 403
-        if row[0] == 'used': return jsonify({"authorized": False, "error": "Key already used"}), 403
-
-        # 5. Activate & Determine File
-        new_expiry = datetime.now() + timedelta(hours=row[1])
-        conn.execute(text("UPDATE licenses SET status = 'used' WHERE key_code = :k"), {"k": provided_key})
-        conn.execute(text("INSERT INTO active_sessions (user_email, expires_at) VALUES (:e, :t)"), {"e": email, "t": new_expiry})
-        conn.commit()
-
-        if requested_file:
-            file_row = conn.execute(text("SELECT gdrive_id FROM file_registry WHERE name = :n"), {"n": requested_file}).fetchone()
-            gdrive_id_to_return = file_row[0] if file_row else DEFAULT_GDRIVE_ID
-        else:
-            row = conn.execute(text("SELECT gdrive_id FROM file_registry LIMIT 1")).fetchone()
-            gdrive_id_to_return = row[0] if row else DEFAULT_GDRIVE_ID
-
-        return jsonify({
-            "authorized": True, "message": f"Activated for {row[1]} hours",
-            "email": email, "hours_remaining": row[1],
-            "gdrive_id": gdrive_id_to_return,
-            "session_token": generate_session_token(email, row[1])
-        })
+    now = datetime.now()
+
+    # 2. Check Session (cache first, then DB)
+    cache_key = (email, requested_file)
+    with _session_cache_lock:
+        cached = _session_cache.get(cache_key)
+    if cached and now < cached[0]:
+        return session_granted(email, *cached, now)
+
+    activation = None
+    # One transaction: an activation's UPDATE and upsert commit together on exit.
+    with engine.begin() as conn:
+        expires_at, file_id = check_session(conn, email, requested_file)
+        has_session = expires_at is not None and now < expires_at
+        if not has_session and provided_key:
+            activation = activate_license(conn, email, provided_key, now)
+
+    if has_session:
+        # 3. GET THE REQUESTED FILE ID
+        if requested_file and not file_id:
+            return jsonify({"authorized": False, "error": f"File '{requested_file}' not found on server."}), 404
+
+        if file_id:
+            with _session_cache_lock:
+                _session_cache[cache_key] = (expires_at, file_id)
+        return session_granted(email, expires_at, file_id, now)
+
+    # 4. Check License Key
+    if not provided_key:
+        return jsonify({"authorized": False, "needs_key": True, "error": "Active license required."}), 401
+
+    new_expiry, duration, error = activation
+    if error: return jsonify({"authorized": False, "error": error}), 403
+
+    if file_id:
+        with _session_cache_lock:
+            _session_cache[cache_key] = (new_expiry, file_id)
+
+    return jsonify({
+        "authorized": True, "message": f"Activated for {duration} hours",
+        "email": email, "hours_remaining": duration,
+        "gdrive_id": file_id or DEFAULT_GDRIVE_ID,
+        "session_token": generate_session_token(email, new_expiry)
+    })
 
 # --- ADMIN ROUTES ---
 
-@app.route('/admin')
-def admin_ui():
-    return """
+# The dashboard is static: encode it and hash its ETag once at import.
+_ADMIN_HTML = """
     <html><body style="font-family:sans-serif; padding: 20px; max-width: 800px; margin: auto;">
         <h1>🛠️ Admin Dashboard</h1>
         
@@ -234,20 +414,44 @@ def admin_ui():
         </script>
     </body></html>
     """
+_ADMIN_HTML_BYTES = _ADMIN_HTML.encode('utf-8')
+_ADMIN_ETAG = hashlib.md5(_ADMIN_HTML_BYTES).hexdigest()
+_ADMIN_HEADERS = {
+    "ETag": f'"{_ADMIN_ETAG}"',
+    "Cache-Control": "private, max-age=60",
+}
+
+@app.route('/admin')
+def admin_ui():
+    if request.if_none_match.contains_weak(_ADMIN_ETAG):
+        return Response(status=304, headers=_ADMIN_HEADERS)
+    return Response(_ADMIN_HTML_BYTES, mimetype='text/html', headers=_ADMIN_HEADERS)
 
 @app.route('/admin/get_files', methods=['GET'])
 def get_files():
+    # Optional pagination: ?limit=N[&offset=M] (the dashboard still loads everything)
+    limit = request.args.get('limit')
+    offset = request.args.get('offset')
+    if limit is None and offset is None:
+        query, params = _Q_LIST_FILES, {}
+    else:
+        try:
+            params = {"lim": int(limit), "off": int(offset or 0)}
+        except (TypeError, ValueError):
+            params = None
+        if params is None or not 1 <= params["lim"] <= 1000 or params["off"] < 0:
+            return jsonify({"status": "error", "message": "limit must be 1-1000 and offset >= 0; offset requires limit"}), 400
+        query = _Q_LIST_FILES_PAGE
     with engine.connect() as conn:
-        rows = conn.execute(text("SELECT name, gdrive_id FROM file_registry ORDER BY id DESC")).fetchall()
-        files = [{"name": r[0], "gdrive_id": r[1]} for r in rows]
-        return jsonify({"files": files})
+        rows = conn.execute(query, params).fetchall()
+    return jsonify({"files": [{"name": r[0], "gdrive_id": r[1]} for r in rows]})
 
 @app.route('/admin/add_file', methods=['POST'])
 def add_file():
     data = request.json
     try:
         with engine.connect() as conn:
-            conn.execute(text("INSERT INTO file_registry (name, gdrive_id) VALUES (:n, :g)"), {"n": data.get('name'), "g": data.get('gdrive_id')})
+            conn.execute(_Q_ADD_FILE, {"n": data.get('name'), "g": data.get('gdrive_id')})
             conn.commit()
         return jsonify({"status": "success"})
     except Exception as e:
@@ -256,13 +460,22 @@ def add_file():
 @app.route('/admin/create', methods=['POST'])
 def create_key():
     data = request.json or {}
-    key = secrets.token_hex(8)
     duration = data.get('duration', 24)
+    # Optional batch: all keys go in with one multi-row INSERT.
+    count = data.get('count', 1)
+    if type(count) is not int or not 1 <= count <= 1000:
+        return jsonify({"status": "error", "message": "count must be an integer from 1 to 1000"}), 400
+    keys = [secrets.token_hex(8) for _ in range(count)]
     with engine.connect() as conn:
-        conn.execute(text("INSERT INTO licenses (key_code, duration_hours) VALUES (:k, :d)"), {"k": key, "d": duration})
+        conn.execute(_Q_ADD_LICENSES, [{"key_code": k, "duration_hours": duration} for k in keys])
         conn.commit()
-    return jsonify({"key": key, "duration": duration})
+    return jsonify({"key": keys[0], "keys": keys, "duration": duration})
+
+@app.route('/health')
+def health():
+    return jsonify({"status": "healthy", "database": "connected"})
 
+# Local development only; production runs `gunicorn app:app` (see gunicorn.conf.py).
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 10000))
     app.run(host='0.0.0.0', port=port)
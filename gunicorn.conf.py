@@ -0,0 +1,40 @@
+# Gunicorn loads this file from the working directory, so a plain
+# `gunicorn app:app` start command picks these settings up.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+# Like `nproc`: count the CPUs this container may run on, not every host CPU.
+workers = int(os.environ.get("WEB_CONCURRENCY", len(os.sched_getaffinity(0))))
+
+# gevent workers overlap the blocking Google / Postgres waits of many
+# concurrent authorize calls instead of serving them one at a time.
+# GUNICORN_WORKER_CLASS (or -k) selects gthread where gevent can't be used.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = 1000
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+
+# Total Postgres connections shared by all workers; keep it below the server's
+# max_connections (100 by default) minus whatever else connects.
+db_max_connections = int(os.environ.get("DB_MAX_CONNECTIONS", 80))
+
+
+def post_fork(server, worker):
+    # Give each worker its share of the connection budget. The app reads these
+    # at import, which happens after fork (don't combine with --preload).
+    # Use the effective worker class: -k / GUNICORN_CMD_ARGS override this file.
+    worker_mode = server.cfg.worker_class_str
+    if worker_mode == "sync" and server.cfg.threads > 1:
+        worker_mode = "gthread"  # gunicorn runs threaded sync workers as gthread
+    per_worker = max(2, db_max_connections // server.cfg.workers)
+    pool_size = per_worker // 2
+    if worker_mode == "gthread":
+        # Let every request thread hold a pooled connection, within the budget.
+        pool_size = min(server.cfg.threads, per_worker)
+    os.environ.setdefault("DB_POOL_SIZE", str(pool_size))
+    os.environ.setdefault("DB_MAX_OVERFLOW", str(per_worker - pool_size))
+
+    if worker_mode != "gevent":
+        return
+    # psycopg2 is a C driver; without this its socket waits block the worker.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()